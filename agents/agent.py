@@ -1,6 +1,5 @@
 from pathlib import Path
 from typing import Optional, Union
-from collections import defaultdict
 
 from beartype import beartype
 from omegaconf import DictConfig
@@ -213,6 +212,11 @@ class Agent(object):
     @beartype
     def sample_batch(self) -> dict[str, torch.Tensor]:
         """Sample a batch of transitions from the replay buffer"""
+        return self.sample_batches(1)[0]
+
+    @beartype
+    def sample_batches(self, n: int) -> list[dict[str, torch.Tensor]]:
+        """Sample n batches of transitions from the replay buffer, all at once"""
         assert self.replay_buffers is not None
 
         # create patcher if needed
@@ -222,22 +226,24 @@ class Agent(object):
 
         patcher = _patcher if self.hps.historical_patching else None
 
-        # get a batch of transitions from replay buffer
-        batches = defaultdict(list)
-        for rb in self.replay_buffers:
-            batch = rb.sample(
-                self.hps.batch_size,
-                patcher=patcher,
-                n_step_returns=self.hps.n_step_returns,
-                lookahead=self.hps.lookahead,
-                gamma=self.hps.gamma,
-            )
-            for k, v in batch.items():
-                batches[k].append(v)
-        out = {}
-        for k, v in batches.items():
-            out[k], _ = pack(v, "* d")  # equiv to: rearrange(v, "n b d -> (n b) d")
-        return out
+        # get n batches of transitions from each replay buffer
+        rbs_batches = [rb.sample_many(
+            n,
+            self.hps.batch_size,
+            patcher=patcher,
+            n_step_returns=self.hps.n_step_returns,
+            lookahead=self.hps.lookahead,
+            gamma=self.hps.gamma,
+        ) for rb in self.replay_buffers]
+        if len(rbs_batches) == 1:
+            # single replay buffer: the batches are already what we want, no concat needed
+            return rbs_batches[0]
+        # pack the j-th batches of every buffer together, straight from the sampled tensors
+        # (one concat per key, equiv to: rearrange(v, "n b d -> (n b) d"))
+        return [
+            {k: pack([rb_batches[j][k] for rb_batches in rbs_batches], "* d")[0]
+             for k in rbs_batches[0][j]}
+            for j in range(n)]
 
     @beartype
     def predict(self, ob: np.ndarray, *, apply_noise: bool) -> np.ndarray:
@@ -597,15 +603,10 @@ class Agent(object):
             # filter out unwanted keys and tensor-ify
             p_batch = {k: batch[k] for k in d_keys}
 
-            # get a batch of samples from the expert dataset
-            e_batches = defaultdict(list)
-            for _ in range(self.hps.num_env):
-                e_batch = self.expert_dataset.sample(self.hps.batch_size, keys=d_keys)
-                for k, v in e_batch.items():
-                    e_batches[k].append(v)
-            e_batch = {}
-            for k, v in e_batches.items():
-                e_batch[k], _ = pack(v, "* d")  # equiv to: rearrange(v, "n b d -> (n b) d")
+            # get a batch of samples from the expert dataset, as large as the agent's batch
+            # note: one draw of num_env x batch_size samples, the same as num_env draws packed
+            e_batch = self.expert_dataset.sample(
+                self.hps.num_env * self.hps.batch_size, keys=d_keys)
 
             # define inputs
             p_input_a = p_batch["obs0"]
@@ -1,117 +1,154 @@
-from typing import Optional, Callable
+import os
+from typing import Optional, Callable, Union
 
 from beartype import beartype
-from einops import repeat, pack, rearrange
 import numpy as np
 import torch
+try:
+    import lz4.frame as lz4f  # optional: only needed to compress the replay buffer
+except ImportError:
+    lz4f = None
 
+from helpers.math_util import nstep_trim
 
-class RingBuffer(object):
-
-    @beartype
-    def __init__(self, maxlen: int, shape: tuple[int, ...], device: torch.device):
-        """Ring buffer implementation"""
-        self.maxlen = maxlen
-        self.start = 0
-        self.length = 0
-        self.data = torch.zeros((maxlen, *shape), dtype=torch.float32, device=device)
-
-    @beartype
-    def __len__(self):
-        return self.length
-
-    @beartype
-    def __getitem__(self, idx: int):
-        if idx < 0 or idx >= self.length:
-            raise KeyError
-        return self.data[(self.start + idx) % self.maxlen]
-
-    @beartype
-    def get_batch(self, idxs: torch.Tensor) -> torch.Tensor:
-        # important: idxs is a numpy array, and start and maxlen are ints
-        return self.data[(self.start + idxs) % self.maxlen]
-
-    @beartype
-    def append(self, *, v: torch.Tensor):
-        if self.length < self.maxlen:
-            # we have space, simply increase the length
-            self.length += 1
-            self.data[(self.start + self.length - 1) % self.maxlen] = v
-        elif self.length == self.maxlen:
-            # no space, remove the first item
-            self.start = (self.start + 1) % self.maxlen
-            self.data[(self.start + self.length - 1) % self.maxlen] = v
-        else:
-            # this should never happen
-            raise RuntimeError
-
-    @beartype
-    @property
-    def latest_entry_idx(self) -> int:
-        return (self.start + self.length - 1) % self.maxlen
-
-    @beartype
-    @classmethod
-    def sanity_check_ringbuffer(cls):
-        # create a RingBuffer object
-        ring_buffer = cls((maxlen := 5), (shape := (3, 2)), device=torch.device("cpu"))
-        # fill the replay buffer with maxlen+1 items
-        new_items = [
-            torch.rand(*shape),
-            (i1 := torch.rand(*shape)),
-            (i2 := torch.rand(*shape)),
-            (i3 := torch.rand(*shape)),
-            (i4 := torch.rand(*shape)),
-            (i5 := torch.rand(*shape)),
-        ]
-        assert len(new_items) == maxlen + 1  # for us
-        for i in range(maxlen + 1):
-            ring_buffer.append(v=new_items[i])
-        # check that the last item added is in first position
-        assert torch.equal(ring_buffer[0], i1)
-        assert torch.equal(ring_buffer[1], i2)
-        assert torch.equal(ring_buffer[2], i3)
-        assert torch.equal(ring_buffer[3], i4)
-        assert torch.equal(ring_buffer[4], i5)
 
+# runtime type-checking of the hot methods (called every env step or every gather)
+# is only enabled in debug mode, i.e. when running with the env var AIL_DEBUG=1
+DEBUG = os.environ.get("AIL_DEBUG", "0") == "1"
+_beartype = beartype if DEBUG else (lambda f: f)
 
 
 class ReplayBuffer(object):
 
+    DEDUP_PAIRS: tuple[tuple[str, str], ...] = (("obs0", "obs1"), ("obs0_orig", "obs1_orig"))
+
     @beartype
     def __init__(self,
                  generator: torch.Generator,
                  capacity: int,
                  erb_shapes: dict[str, tuple[int, ...]],
-                 device: torch.device):
+                 device: torch.device,
+                 *,
+                 compress_keys: Optional[set[str]] = None,
+                 dedup_obs: bool = False,
+                 erb_dtypes: Optional[dict[str, torch.dtype]] = None):
+        """Replay buffer implementation: one contiguous slab per key, all the slabs
+        sharing the same ring index arithmetic (single start, length, and capacity)
+        The keys in `compress_keys` are stored on the host as LZ4-compressed rows instead
+        (worth it for large observations, e.g. images, not for low-dim vectors)
+        With `dedup_obs`, next observations get no slab of their own: within an episode,
+        the next ob of a slot is the current ob of the slot that follows; only the next obs
+        that break this chain (episode ends, resets) are kept apart, one row each
+        The keys in `erb_dtypes` are stored in the given dtype (float32 otherwise), e.g.
+        float16 obs and acs halve the bytes moved on every gather; gathered rows are always
+        upcast to float32 for the nets (image obs, if any, should stay stored as uint8)
+        """
         self.rng = generator
         self.capacity = capacity
         self.erb_shapes = erb_shapes
         self.device = device
-        self.ring_buffers = {
-            k: RingBuffer(self.capacity, s, self.device) for k, s in self.erb_shapes.items()}
+        self.erb_dtypes = {
+            k: (erb_dtypes or {}).get(k, torch.float32) for k in self.erb_shapes}
+        assert self.erb_dtypes["rews"] == torch.float32, "rews are written by the buffer itself"
+        self.compress_keys = compress_keys if compress_keys is not None else set()
+        assert self.compress_keys <= set(self.erb_shapes.keys()), "unknown key to compress"
+        assert "rews" not in self.compress_keys, "rews are written by the buffer itself"
+        assert lz4f is not None or not self.compress_keys, "compression requires lz4"
+        # map each deduplicated next-ob key to the current-ob key it is read from
+        self.dedup_pairs = {
+            k1: k0 for k0, k1 in self.DEDUP_PAIRS
+            if dedup_obs and k0 in self.erb_shapes and k1 in self.erb_shapes}
+        assert not (set(self.dedup_pairs) & self.compress_keys), "deduped keys have no slab"
+        self.slabs: dict[str, Union[torch.Tensor, list[Optional[bytes]]]] = {
+            k: ([None] * self.capacity) if k in self.compress_keys else torch.zeros(
+                (self.capacity, *s), dtype=self.erb_dtypes[k], device=self.device)
+            for k, s in self.erb_shapes.items() if k not in self.dedup_pairs}
+        # compressed rows are (de)serialized through numpy, in the dtype of their key
+        # (numpy has no bfloat16: such rows are kept as their raw 16 bits, in uint16)
+        self._np_dtypes = {
+            k: np.dtype(np.uint16) if self.erb_dtypes[k] == torch.bfloat16
+            else torch.empty(0, dtype=self.erb_dtypes[k]).numpy().dtype
+            for k in self.compress_keys}
+        # slots whose next ob is not in the following slot, and these next obs
+        self._brk_flags = {
+            k: torch.zeros(self.capacity, dtype=torch.bool, device=self.device)
+            for k in self.dedup_pairs}
+        self._brk_rows: dict[str, dict[int, torch.Tensor]] = {k: {} for k in self.dedup_pairs}
+        self._last_next: dict[str, np.ndarray] = {}  # next obs of the latest entry
+        # discount factors of the n-step returns, computed once per (lookahead, gamma)
+        self._gamma_pows: dict[tuple[int, float], torch.Tensor] = {}
+        # on gpu: pinned host tensors the new transitions are stacked into (allocated once,
+        # grown to the largest batch seen, i.e. a segment), and the event of their last copy
+        self._staging: dict[str, torch.Tensor] = {}
+        self._staged: Optional[torch.cuda.Event] = None
+        self._start = 0
+        self._length = 0
+        self._write_pos = 0  # maintained directly, not to recompute it on every append
 
-    @beartype
+    @_beartype
+    def __len__(self) -> int:
+        return self._length
+
+    @_beartype
+    def __getitem__(self, idx: int) -> dict[str, torch.Tensor]:
+        if idx < 0 or idx >= self._length:
+            raise KeyError
+        pos = (self._start + idx) % self.capacity
+        phys = torch.tensor([pos], device=self.device)
+        return {k: self.gather(k, phys)[0] for k in self.erb_shapes}
+
+    @_beartype
+    def gather(self, k: str, phys: torch.Tensor) -> torch.Tensor:
+        """Collect the rows of physical indices `phys` from the slab of key `k`"""
+        if k in self.dedup_pairs:
+            # read the current ob of the following slot, and patch the rows at chain breaks
+            # (these read their own slot first, since the following one may still be empty)
+            brks = self._brk_flags[k][phys]
+            nxt = torch.where(brks, phys, (phys + 1).remainder_(self.capacity))
+            out = self.gather(self.dedup_pairs[k], nxt)
+            # fetch the break rows and their slots in one go, not one device sync per row
+            rows = brks.nonzero().flatten()
+            for r, p in zip(rows.tolist(), phys[rows].tolist(), strict=True):
+                out[r] = self._brk_rows[k][p]
+            return out
+        slab = self.slabs[k]
+        if isinstance(slab, torch.Tensor):
+            return slab[phys].float()  # no-op when stored as float32
+        assert lz4f is not None
+        # decompress only the sampled rows, straight into a preallocated array
+        shape = self.erb_shapes[k]
+        out = np.empty((phys.numel(), *shape), dtype=np.float32)
+        for i, p in enumerate(phys.tolist()):
+            row = slab[p]
+            assert row is not None, "gathering from an empty slot"
+            out[i] = self._unpack_row(k, lz4f.decompress(row)).reshape(shape)
+        return torch.from_numpy(out).to(self.device)
+
+    @_beartype
+    def _pack_row(self, k: str, row: np.ndarray) -> bytes:
+        """Serialize a row of the compressed key `k` in the storage dtype of this key"""
+        if self.erb_dtypes[k] == torch.bfloat16:
+            # round to bfloat16 in torch, then keep the bits
+            bf16 = torch.from_numpy(np.ascontiguousarray(row, dtype=np.float32)).to(torch.bfloat16)
+            return bf16.view(torch.int16).numpy().tobytes()
+        return np.ascontiguousarray(row, dtype=self._np_dtypes[k]).tobytes()
+
+    @_beartype
+    def _unpack_row(self, k: str, raw: bytes) -> np.ndarray:
+        """Deserialize a row of the compressed key `k` (flat, castable to float32)"""
+        row = np.frombuffer(raw, dtype=self._np_dtypes[k])
+        if self.erb_dtypes[k] == torch.bfloat16:
+            # bfloat16 is the upper half of float32: shift the bits back in place
+            return (row.astype(np.uint32) << 16).view(np.float32)
+        return row
+
+    @_beartype
     def get_trns(self, idxs: torch.Tensor) -> dict[str, torch.Tensor]:
         """Collect a batch from indices"""
-        trns = {}
-        for k, v in self.ring_buffers.items():
-            trns[k] = v.get_batch(idxs)
-        return trns
-
-    @beartype
-    def discount(self, x: torch.Tensor, gamma: float) -> torch.Tensor:
-        """Compute gamma-discounted sum"""
-        c = x.size(0)
-        reps = repeat(x, "k 1 -> c k", c=c)  # note: k in einstein notation is c
-        mats = [
-            (gamma ** (c - j)) *
-                torch.diagflat(torch.ones(j, device=self.device), offset=(c - j))
-            for j in reversed(range(1, c + 1))]
-        mats, _ = pack(mats, "* h w")
-        out = rearrange(torch.sum(reps * torch.sum(mats, dim=0), dim=1), "k -> k 1")
-        assert out.size() == x.size()
-        return out[0]  # would be simpler to just compute the 1st elt, but only used in n-step rets
+        # compute the physical indices once, shared by every key
+        # (before the buffer wraps, logical and physical indices coincide: no temporary)
+        phys = idxs if self._start == 0 else (idxs + self._start).remainder_(self.capacity)
+        return {k: self.gather(k, phys) for k in self.erb_shapes}
 
     @beartype
     def sample(self,
@@ -124,73 +161,81 @@ class ReplayBuffer(object):
                gamma: Optional[float] = None,
         ) -> dict[str, torch.Tensor]:
         """Sample transitions uniformly from the replay buffer"""
+        return self.sample_many(
+            1,
+            batch_size,
+            patcher=patcher,
+            n_step_returns=n_step_returns,
+            lookahead=lookahead,
+            gamma=gamma,
+        )[0]
+
+    @beartype
+    def sample_many(self,
+                    n_batches: int,
+                    batch_size: int,
+                    *,
+                    patcher: Optional[Callable[[torch.Tensor, torch.Tensor, torch.Tensor],
+                                               torch.Tensor]],
+                    n_step_returns: bool = False,
+                    lookahead: Optional[int] = None,
+                    gamma: Optional[float] = None,
+        ) -> list[dict[str, torch.Tensor]]:
+        """Sample several batches of transitions uniformly from the replay buffer,
+        with one draw of indices, one gather, and one patcher call for all of them
+        """
+        tot_size = n_batches * batch_size
         idxs = torch.randint(
             low=0,
             high=self.num_entries,
-            size=(batch_size,),
+            size=(tot_size,),
             generator=self.rng,
             device=self.device,
         )
         if n_step_returns:
             assert lookahead is not None and gamma is not None
             assert 0 <= gamma <= 1
-            # initiate the batch of transition data necessary to perform n-step TD backups
-            la_keys = list(self.erb_shapes.keys())
-            la_keys.extend(["td_len", "obs1_td1"])
-            la_batch = {k: [] for k in la_keys}  # could use defaultdict but keys known
-            # iterate over the indices to deploy the n-step backup for each
-            for _idx in idxs:
-                idx = _idx.item()
-                # create indexes of transitions in lookahead
-                # of lengths max `lookahead` following sampled one
-                la_end_idx = min(idx + lookahead, self.num_entries) - 1
-                assert isinstance(idx, int) and isinstance(la_end_idx, int)
-
-                # the following are all tensors
-                la_idxs = torch.arange(idx, la_end_idx + 1, device=self.device)
-                # collect the batch for the lookahead rollout indices
-                la_trns = self.get_trns(la_idxs)
-                if patcher is not None:
-                    # patch the rewards
-                    la_trns["rews"] = patcher(la_trns["obs0"], la_trns["acs"], la_trns["obs1"])
-                # only keep data from the current episode,
-                # drop everything after episode reset, if any
-                dones = la_trns["dones1"]
-
-                # the following are all ints
-                term_idx = 1.0
-
-                ep_end_idx = int(
-                    idx + torch.argmax(dones.float()).item() if term_idx in dones else la_end_idx)
-                # doc: if there are multiple maximal values in a reduced row
-                # then the indices of the first maximal value are returned.
-
-                la_is_trimmed = 0 if ep_end_idx == la_end_idx else 1
-                # compute lookahead length
-                td_len = ep_end_idx - idx + 1
-
-                # trim down the lookahead transitions
-                la_rews = la_trns["rews"][:td_len]
-                # compute discounted cumulative reward
-                la_discounted_sum_n_rews = self.discount(la_rews, gamma)
-                # populate the batch for this n-step TD backup
-                la_batch["obs0"].append(la_trns["obs0"][0])
-                la_batch["obs1"].append(la_trns["obs1"][td_len - 1])
-                la_batch["acs"].append(la_trns["acs"][0])
-                la_batch["rews"].append(la_discounted_sum_n_rews)
-                la_batch["dones1"].append(torch.Tensor([la_is_trimmed]).to(self.device))
-                la_batch["td_len"].append(torch.Tensor([td_len]).to(self.device))
+            # gather the lookahead windows of all the sampled indices at once
+            # note: windows are cut short at the end of the buffer; the cropped positions are
+            # clamped onto the last entry and then masked out
+            offsets = torch.arange(lookahead, device=self.device)
+            if (gp_key := (lookahead, gamma)) not in self._gamma_pows:
+                self._gamma_pows[gp_key] = gamma ** offsets.float()
+            gamma_pows = self._gamma_pows[gp_key]
+            grid = idxs[:, None] + offsets[None, :]  # [B, n]
+            in_range = grid < self.num_entries
+            grid = grid.clamp(max=self.num_entries - 1)
+            la_trns = self.get_trns(grid.flatten())  # equiv to: "b n -> (b n)"
+            if patcher is not None:
+                # patch the rewards, in one call over all the lookahead windows
+                la_trns["rews"] = patcher(la_trns["obs0"], la_trns["acs"], la_trns["obs1"])
+            la_trns = {  # equiv to: "(b n) d -> b n d"
+                k: v.reshape(tot_size, lookahead, *v.shape[1:]) for k, v in la_trns.items()}
+            # only keep data from the current episode,
+            # drop everything after episode reset, if any
+            dones = la_trns["dones1"][..., 0].bool() & in_range  # [B, n]
+            la_len = in_range.sum(dim=1)  # length of the window before being cut short
+            la_discounted_sum_n_rews, td_len, la_is_trimmed, ep_end = nstep_trim(
+                la_trns["rews"][..., 0], dones, la_len, gamma_pows)
+            # assemble the batch for the n-step TD backup
+            rows = torch.arange(tot_size, device=self.device)
+            trns = {
+                "obs0": la_trns["obs0"][:, 0],
+                "obs1": la_trns["obs1"][rows, ep_end],
+                "acs": la_trns["acs"][:, 0],
+                "rews": la_discounted_sum_n_rews,
+                "dones1": la_is_trimmed,
+                "td_len": td_len,
                 # add the first next state too: needed in state-only discriminator
-                la_batch["obs1_td1"].append(la_trns["obs1"][0])
-                # when dealing with absorbing states
-                if "obs0_orig" in la_keys:
-                    la_batch["obs0_orig"].append(la_trns["obs0_orig"][0])
-                if "obs1_orig" in la_keys:
-                    la_batch["obs1_orig"].append(la_trns["obs1_orig"][td_len - 1])
-                if "acs_orig" in la_keys:
-                    la_batch["acs_orig"].append(la_trns["acs_orig"][0])
-            # turn the list defaultdict into a dict of np.ndarray
-            trns = {k: pack(v, "* d")[0] for k, v in la_batch.items()}
+                "obs1_td1": la_trns["obs1"][:, 0],
+            }
+            # when dealing with absorbing states
+            if "obs0_orig" in la_trns:
+                trns["obs0_orig"] = la_trns["obs0_orig"][:, 0]
+            if "obs1_orig" in la_trns:
+                trns["obs1_orig"] = la_trns["obs1_orig"][rows, ep_end]
+            if "acs_orig" in la_trns:
+                trns["acs_orig"] = la_trns["acs_orig"][:, 0]
             for k, v in trns.items():
                 assert v.device == self.device, f"v for {k=} is on wrong device"
         else:
@@ -198,46 +243,136 @@ class ReplayBuffer(object):
             if patcher is not None:
                 # patch the rewards
                 trns["rews"] = patcher(trns["obs0"], trns["acs"], trns["obs1"])
-        return trns
+        # split into the individual batches (views, no copy)
+        return [{k: v[i * batch_size:(i + 1) * batch_size] for k, v in trns.items()}
+                for i in range(n_batches)]
 
-    @beartype
+    @_beartype
     def append(self, trn: dict[str, np.ndarray],
                *,
                rew_func: Callable[[torch.Tensor, torch.Tensor, torch.Tensor], torch.Tensor]):
         """Add a transition to the replay buffer"""
-        assert {k for k in self.ring_buffers if k != "rews"} == set(trn.keys()), "key mismatch"
-        for k in self.ring_buffers:
-            if k == "rews":
-                continue
-            if not isinstance(trn[k], np.ndarray):
-                raise TypeError(k)
-            new_tensor = torch.Tensor(trn[k]).to(self.device)
-            self.ring_buffers[k].append(v=new_tensor)
-        # also add the synthetic reward to the replay buffer
+        self.extend([trn], rew_func=rew_func)
+
+    @_beartype
+    def extend(self, trns: list[dict[str, np.ndarray]],
+               *,
+               rew_func: Callable[[torch.Tensor, torch.Tensor, torch.Tensor], torch.Tensor]):
+        """Add a sequence of transitions to the replay buffer, in order"""
+        if len(trns) == 0:
+            return
+        assert len(trns) <= self.capacity, "more transitions than slots"
+        keys = {k for k in self.erb_shapes if k != "rews"}
+        for trn in trns:
+            assert keys == set(trn.keys()), "key mismatch"
+            for k, v in trn.items():
+                if not isinstance(v, np.ndarray):
+                    raise TypeError(k)
+        n = len(trns)
+        # stack each key on the host, and move it to the device in one go
+        new_tensors = {}
+        if self.device.type == "cuda":
+            # stacked straight into the pinned staging tensors, so the copies are asynchronous
+            if self._staged is not None:
+                # the previous copies out of the staging tensors must be over before reuse
+                # (long over by now in practice, a segment of env steps ago)
+                self._staged.synchronize()
+            for k in keys:
+                if k not in self._staging or self._staging[k].size(0) < n:
+                    self._staging[k] = torch.empty(
+                        (n, *self.erb_shapes[k]), dtype=torch.float32, pin_memory=True)
+                stage = self._staging[k][:n]
+                np.stack([trn[k] for trn in trns], out=stage.numpy(), casting="unsafe")
+                new_tensors[k] = stage.to(self.device, non_blocking=True)
+            self._staged = torch.cuda.Event()
+            self._staged.record()
+        else:
+            for k in keys:
+                new_tensors[k] = torch.from_numpy(
+                    np.stack([trn[k] for trn in trns]).astype(np.float32, copy=False))
+        # the slots are consecutive: their indices are built on device, not copied over
+        pos_tensor = (self._write_pos + torch.arange(n, device=self.device)) % self.capacity
+        for i, trn in enumerate(trns):
+            had_entries = self._length > 0
+            # advance the write cursor once for all the keys
+            pos = self._write_pos
+            self._write_pos = (pos + 1) % self.capacity
+            if self._length < self.capacity:
+                # we have space, simply increase the length
+                self._length += 1
+            else:
+                # no space, remove the first item (the oldest one is right under the cursor)
+                self._start = self._write_pos
+            for k in self.compress_keys:
+                slab = self.slabs[k]
+                assert isinstance(slab, list) and lz4f is not None
+                slab[pos] = lz4f.compress(self._pack_row(k, trn[k]))
+            for k1, k0 in self.dedup_pairs.items():
+                prev = (pos - 1) % self.capacity
+                if had_entries and np.array_equal(trn[k0], self._last_next[k1]):
+                    # the previous entry carries on into this one: its next ob is in this slot
+                    self._brk_flags[k1][prev] = False
+                    self._brk_rows[k1].pop(prev, None)
+                # keep the next ob of this slot apart until the following entry comes in
+                self._brk_flags[k1][pos] = True
+                # note: rounded like the slab it stands in for
+                self._brk_rows[k1][pos] = new_tensors[k1][i].to(
+                    self.erb_dtypes[k0], copy=True).float()
+                self._last_next[k1] = trn[k1].copy()
+        # write the uncompressed slabs for all the transitions at once
+        for k in keys:
+            slab = self.slabs.get(k)
+            if isinstance(slab, torch.Tensor):
+                slab[pos_tensor] = new_tensors[k].to(slab.dtype)
+        # also add the synthetic rewards to the replay buffer, computed in one batch
         # note: by this point everything is already as a tensor on device
-        rew = rew_func(
-            *(rearrange(x, "d -> 1 d") for x in [
-                self.ring_buffers["obs0"][self.latest_entry_idx],
-                self.ring_buffers["acs"][self.latest_entry_idx],
-                self.ring_buffers["obs1"][self.latest_entry_idx],
-            ]),
-        )
-        self.ring_buffers["rews"].append(v=rew)
-        # sanity-check that all the ring buffers are at the same stage
-        last_idxs = [li := v.latest_entry_idx for v in self.ring_buffers.values()]
-        assert all(ll == li for ll in last_idxs), "not all equal"
+        rew = rew_func(new_tensors["obs0"], new_tensors["acs"], new_tensors["obs1"])
+        rews = self.slabs["rews"]
+        assert isinstance(rews, torch.Tensor)
+        rews[pos_tensor] = rew
 
     @beartype
     def __repr__(self) -> str:
         shapes = "|".join([f"[{k}:{s}]" for k, s in self.erb_shapes.items()])
-        return f"ReplayBuffer(capacity={self.capacity}, shapes={shapes})"
+        comp = "|".join(sorted(self.compress_keys))
+        dedup = "|".join(sorted(self.dedup_pairs))
+        return (f"ReplayBuffer(capacity={self.capacity}, shapes={shapes}, "
+                f"compressed=[{comp}], deduped=[{dedup}])")
 
-    @beartype
+    @_beartype
     @property
     def latest_entry_idx(self) -> int:
-        return self.ring_buffers["obs0"].latest_entry_idx  # could pick any other key
+        return (self._write_pos - 1) % self.capacity
 
-    @beartype
+    @_beartype
     @property
     def num_entries(self) -> int:
-        return len(self.ring_buffers["obs0"])  # could pick any other key
+        return self._length
+
+    @beartype
+    @classmethod
+    def sanity_check_replaybuffer(cls):
+        # create a ReplayBuffer object
+        shapes = {"obs0": (3,), "acs": (2,), "obs1": (3,), "rews": (1,), "dones1": (1,)}
+        replay_buffer = cls(
+            generator=torch.Generator(),
+            capacity=(maxlen := 5),
+            erb_shapes=shapes,
+            device=torch.device("cpu"),
+        )
+
+        @beartype
+        def _rew_func(x: torch.Tensor, y: torch.Tensor, z: torch.Tensor) -> torch.Tensor:
+            return torch.zeros(x.size(0), 1)
+
+        # fill the replay buffer with maxlen+1 items
+        new_items = [
+            {k: np.random.default_rng(i).random(s) for k, s in shapes.items() if k != "rews"}
+            for i in range(maxlen + 1)]
+        assert len(new_items) == maxlen + 1  # for us
+        for i in range(maxlen + 1):
+            replay_buffer.append(new_items[i], rew_func=_rew_func)
+        # check that the first item added got evicted, and that the others shifted by one
+        for i in range(maxlen):
+            for k, v in new_items[i + 1].items():
+                assert torch.equal(replay_buffer[i][k], torch.Tensor(v))
@@ -86,7 +86,7 @@ def make_farama_mujoco_env(
     # normally the windowed one is "human" .other option for later: "rgb_array", but prefer:
     # the following: `from gymnasium.wrappers.pixel_observation import PixelObservationWrapper`
     if record:  # overwrites render
-        env = gym.make(env_id, render_mode="rgb_array_list")
+        env = gym.make(env_id, render_mode="rgb_array")
     elif render:
         env = gym.make(env_id, render_mode="human")
         # reference: https://younis.dev/blog/render-api/
@@ -17,3 +17,31 @@ def huber_quant_reg_loss(
            (torch.abs(td_errors) - (0.5 * kappa)) *
            (torch.abs(td_errors) > kappa).float())
     return torch.abs(quantile - ((td_errors.le(0.)).float())) * aux / kappa
+
+
+@beartype
+def nstep_trim(rews: torch.Tensor,
+               dones: torch.Tensor,
+               la_len: torch.Tensor,
+               gamma_pows: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor,
+                                                  torch.Tensor]:
+    """Trim a batch of lookahead windows at the first episode end and compute
+    their gamma-discounted sums of rewards, all rows at once.
+    `rews` and `dones` are [B, n] (dones being boolean), `la_len` is [B] and holds
+    the length of each window before it gets trimmed (windows can be cut short), and
+    `gamma_pows` is [n] and holds the discount factors gamma^k (precomputed by the caller).
+    Returns the discounted n-step returns, the TD lengths, whether the windows were
+    trimmed (all [B, 1]), and the in-window index of the last kept transition ([B]).
+    """
+    offsets = torch.arange(n := rews.size(1), device=rews.device)
+    # index of the first done of each row (n if none) in a single reduction, no argmax
+    # (windows cut short have no done past their length, so the min keeps the first done)
+    first_done = torch.where(dones, offsets[None, :], n).amin(dim=1)
+    tail_idx = torch.minimum(first_done, la_len - 1)
+    # note: plain indexing instead of einops, this is on the sampling hot path
+    trimmed = (tail_idx != la_len - 1).float()[:, None]
+    td_len = (tail_idx + 1).float()[:, None]
+    # only keep data from the current episode, drop everything after episode reset, if any
+    valid = offsets[None, :] <= tail_idx[:, None]
+    ret = (rews * valid * gamma_pows[None, :]).sum(dim=1, keepdim=True)
+    return ret, td_len, trimmed, tail_idx
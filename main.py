@@ -173,17 +173,29 @@ class MagicRunner(object):
         )
         logger.info(f"dd#0 [{expert_dataset}] is set")
 
+        # keys compressed in the replay buffers, if any
+        compress_keys = {k for k in erb_shapes if k.startswith("obs")}
+        if self._cfg.mem_dedup_obs:
+            # the next obs are not stored in a slab of their own
+            compress_keys -= {"obs1", "obs1_orig"}
+        # storage dtype of the obs and acs in the replay buffers (rews and dones stay float32)
+        erb_dtypes = {
+            k: getattr(torch, self._cfg.mem_dtype)
+            for k in erb_shapes if k.startswith(("obs", "acs"))}
         replay_buffers = [ReplayBuffer(
             generator=torch.Generator(device).manual_seed(self._cfg.seed),
             capacity=self._cfg.mem_size,
             erb_shapes=erb_shapes,
             device=device,
+            compress_keys=compress_keys if self._cfg.mem_compress else None,
+            dedup_obs=self._cfg.mem_dedup_obs,
+            erb_dtypes=erb_dtypes,
         ) for _ in range(self._cfg.num_env)]
         for i, rb in enumerate(replay_buffers):
             logger.info(f"rb#{i} [{rb}] is set")
 
-        # perform quick sanity check on a ring buffer data structure
-        replay_buffers[0].ring_buffers["acs"].sanity_check_ringbuffer()
+        # perform quick sanity check on the replay buffer data structure
+        ReplayBuffer.sanity_check_replaybuffer()
 
         @beartype
         def agent_wrapper() -> Agent:
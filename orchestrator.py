@@ -1,12 +1,11 @@
 import time
-from copy import deepcopy
+from collections import defaultdict
 from pathlib import Path
-from functools import partial
-from typing import Union, Callable, ContextManager
+from functools import partial, cache
+from typing import Optional, Union, Callable, ContextManager
 from contextlib import contextmanager, nullcontext
 
 from beartype import beartype
-from einops import rearrange
 from termcolor import colored
 from omegaconf import OmegaConf, DictConfig
 import wandb
@@ -48,6 +47,34 @@ def timed(op: str, timer: Callable[[], float]):
         "magenta"))
 
 
+class RunningStats(object):
+
+    @beartype
+    def __init__(self):
+        """Streaming sums and counts per key: average without keeping every value around"""
+        self.sums: defaultdict[str, float] = defaultdict(float)
+        self.counts: defaultdict[str, int] = defaultdict(int)
+
+    @beartype
+    def add(self, k: str, v: float):
+        self.sums[k] += v
+        self.counts[k] += 1
+
+    @beartype
+    def sum(self, k: str) -> float:
+        return self.sums[k]
+
+    @beartype
+    def mean(self, k: str) -> float:
+        # like the mean of an empty array, nan when nothing was added
+        return self.sums[k] / self.counts[k] if self.counts[k] > 0 else float("nan")
+
+    @beartype
+    def clear(self):
+        self.sums.clear()
+        self.counts.clear()
+
+
 @beartype
 def segment(env: Union[Env, AsyncVectorEnv, SyncVectorEnv],
             agent: Agent,
@@ -61,6 +88,11 @@ def segment(env: Union[Env, AsyncVectorEnv, SyncVectorEnv],
 
     assert agent.replay_buffers is not None
 
+    # transitions are only stored in the replay buffers right before yielding, one batch
+    # per buffer, so that their synthetic rewards are computed in one call per segment
+    # (the discriminator does not change within a segment)
+    pending: list[list[dict[str, np.ndarray]]] = [[] for _ in agent.replay_buffers]
+
     t = 0
 
     ob, _ = env.reset(seed=seed)  # seed is a keyword argument, not positional
@@ -70,11 +102,14 @@ def segment(env: Union[Env, AsyncVectorEnv, SyncVectorEnv],
         # predict action
         assert isinstance(ob, np.ndarray)
         ac = agent.predict(ob, apply_noise=True)
-        # nan-proof and clip
-        ac = np.nan_to_num(ac)
-        ac = np.clip(ac, ac_low, ac_high)
+        # nan-proof and clip, both in place on the array returned by `predict` (writable)
+        np.nan_to_num(ac, copy=False)
+        np.clip(ac, ac_low, ac_high, out=ac)
 
         if t > 0 and t % segment_len == 0:
+            for rb, trns in zip(agent.replay_buffers, pending, strict=True):
+                rb.extend(trns, rew_func=agent.get_syn_rew)
+                trns.clear()
             yield
 
         # interact with env
@@ -93,7 +128,8 @@ def segment(env: Union[Env, AsyncVectorEnv, SyncVectorEnv],
                 logger.warn("termination caused by something like time limit or out of bounds?")
         else:
             done = np.logical_or(terminated, truncated)  # might not be used but diagnostics
-            done, terminated = rearrange(done, "b -> b 1"), rearrange(terminated, "b -> b 1")
+            # plain indexing: einops parses its pattern on every call, and this runs every step
+            done, terminated = done[:, None], terminated[:, None]  # equiv to: "b -> b 1"
         # read about what truncation means at the link below:
         # https://gymnasium.farama.org/tutorials/gymnasium_basics/handling_time_limits/#truncation
 
@@ -109,12 +145,11 @@ def segment(env: Union[Env, AsyncVectorEnv, SyncVectorEnv],
         outss = pp_func(tr_or_vtr, agent.ob_shape, agent.ac_shape, wrap_absorb=wrap_absorb)
         assert outss is not None
         for i, outs in enumerate(outss):
-            for out in outs:
-                # add transition to the i-th replay buffer
-                agent.replay_buffers[i].append(out, rew_func=agent.get_syn_rew)
+            # queue the transitions for the i-th replay buffer
+            pending[i].extend(outs)
 
         # set current state with the next
-        ob = deepcopy(new_ob)
+        ob = np.array(new_ob, copy=True)  # plain array copy: no object graph traversal
 
         if not isinstance(env, (AsyncVectorEnv, SyncVectorEnv)):
             assert isinstance(env, Env)
@@ -148,6 +183,28 @@ def postproc_vtr(num_envs: int,
     return vouts
 
 
+@beartype
+def pad_with(x: np.ndarray, v: float) -> np.ndarray:
+    """Append value v to the 1-dim array x, in a single allocation (unlike `np.append`)"""
+    out = np.empty(x.shape[-1] + 1, dtype=x.dtype)
+    out[:-1] = x
+    out[-1] = v
+    return out
+
+
+@cache
+@beartype
+def absorbing_vecs(ob_dim: int, ac_dim: int) -> tuple[np.ndarray, np.ndarray]:
+    """Absorbing ob and ac (zeros then a one), built once per shape and shared read-only
+    across transitions: the replay buffers copy what they store, so sharing is safe
+    """
+    ob_zeros_1 = pad_with(np.zeros(ob_dim), 1.)
+    ac_zeros_1 = pad_with(np.zeros(ac_dim), 1.)
+    ob_zeros_1.flags.writeable = False
+    ac_zeros_1.flags.writeable = False
+    return ob_zeros_1, ac_zeros_1
+
+
 @beartype
 def postproc_tr(tr: list[np.ndarray],
                 ob_shape: tuple[int, ...],
@@ -159,30 +216,27 @@ def postproc_tr(tr: list[np.ndarray],
 
     if wrap_absorb:
 
-        ob_0 = np.append(ob, 0)
-        ac_0 = np.append(ac, 0)
+        ob_0 = pad_with(ob, 0.)
+        ac_0 = pad_with(ac, 0.)
 
         # previously this was the cond: `done and env._elapsed_steps != env._max_episode_steps`
         if terminated:
             # wrap with an absorbing state
-            new_ob_zeros_1 = np.append(np.zeros(ob_shape[-1]), 1)
+            ob_zeros_1, ac_zeros_1 = absorbing_vecs(ob_shape[-1], ac_shape[-1])
             transition = {
                 "obs0": ob_0,
                 "acs": ac_0,
-                "obs1": new_ob_zeros_1,
+                "obs1": ob_zeros_1,
                 "dones1": terminated,
                 "obs0_orig": ob,
                 "acs_orig": ac,
                 "obs1_orig": new_ob,
             }
             # add absorbing transition
-            ob_zeros_1 = np.append(np.zeros(ob_shape[-1]), 1)
-            ac_zeros_1 = np.append(np.zeros(ac_shape[-1]), 1)
-            new_ob_zeros_1 = np.append(np.zeros(ob_shape[-1]), 1)
             transition_a = {
                 "obs0": ob_zeros_1,
                 "acs": ac_zeros_1,
-                "obs1": new_ob_zeros_1,
+                "obs1": ob_zeros_1,
                 "dones1": terminated,
                 "obs0_orig": ob,  # from previous transition, with reward eval on absorbing
                 "acs_orig": ac,  # from previous transition, with reward eval on absorbing
@@ -190,7 +244,7 @@ def postproc_tr(tr: list[np.ndarray],
             }
             return [(transition, transition_a)]
 
-        new_ob_0 = np.append(new_ob, 0)
+        new_ob_0 = pad_with(new_ob, 0.)
         transition = {
             "obs0": ob_0,
             "acs": ac_0,
@@ -214,66 +268,90 @@ def postproc_tr(tr: list[np.ndarray],
 @beartype
 def episode(env: Env,
             agent: Agent,
-            seed: int):
+            seed: int,
+            *,
+            collect_rgb: bool = False):
     # generator that spits out a trajectory collected during a single episode
-    # `append` operation is also significantly faster on lists than numpy arrays,
-    # they will be converted to numpy arrays once complete right before the yield
+    # the trajectory is written into arrays preallocated once for the longest episode,
+    # and the yielded arrays are views on these: only valid until the next episode starts
+    # with `collect_rgb`, frames are rendered too and yielded under "obs_rgb" (the env must
+    # then have been made with "rgb_array"); their buffer of max_ep_steps + 1 frames stays
+    # allocated for the whole lifetime of the generator, unlike a list freed every episode
+    # (e.g. 1000 steps of 480x480 mujoco frames hold about 690MB for the whole run)
 
     assert isinstance(env.action_space, gym.spaces.Box)  # to ensure `high` and `low` exist
     ac_low, ac_high = env.action_space.low, env.action_space.high
 
+    assert env.spec is not None
+    max_ep_steps = env.spec.max_episode_steps
+    assert max_ep_steps is not None
+    obs = np.empty((max_ep_steps, *agent.ob_shape), dtype=env.observation_space.dtype)
+    acs = np.empty((max_ep_steps, *agent.ac_shape), dtype=env.action_space.dtype)
+    env_rews = np.empty(max_ep_steps, dtype=np.float64)
+    # bounded frame buffer, allocated once the frame shape is known (first render)
+    obs_rgb: Optional[np.ndarray] = None
+
+    def render_into(t: int):
+        nonlocal obs_rgb
+        frame = env.render()
+        assert isinstance(frame, np.ndarray)
+        if obs_rgb is None:
+            # one more slot than steps, for the frame right after the reset
+            obs_rgb = np.empty((max_ep_steps + 1, *frame.shape), dtype=frame.dtype)
+        obs_rgb[t] = frame
+
     rng = np.random.default_rng(seed)  # aligned on seed, so always reproducible
     logger.warn("remember: in episode generator, we generate a seed randomly")
     logger.warn("i.e. not using 'ob, _ = env.reset(seed=seed)' with same seed")
     # note that despite sampling a new seed, it is using a seeded rng: reproducible
     ob, _ = env.reset(seed=seed + rng.integers(100000, size=1).item())
+    if collect_rgb:
+        render_into(0)
 
-    cur_ep_len = 0
+    cur_ep_len = 0  # also the write cursor in the preallocated arrays
     cur_ep_env_ret = 0
-    obs = []
-    acs = []
-    env_rews = []
 
     while True:
 
         # predict action
         ac = agent.predict(ob, apply_noise=False)
-        # nan-proof and clip
-        ac = np.nan_to_num(ac)
-        ac = np.clip(ac, ac_low, ac_high)
+        # nan-proof and clip, both in place on the array returned by `predict` (writable)
+        np.nan_to_num(ac, copy=False)
+        np.clip(ac, ac_low, ac_high, out=ac)
 
-        obs.append(ob)
-        acs.append(ac)
+        obs[cur_ep_len] = ob
+        acs[cur_ep_len] = ac
         new_ob, env_rew, terminated, truncated, _ = env.step(ac)
         done = terminated or truncated
 
-        env_rews.append(env_rew)
+        env_rews[cur_ep_len] = env_rew
         cur_ep_len += 1
         assert isinstance(env_rew, float)  # quiets the type-checker
         cur_ep_env_ret += env_rew
-        ob = deepcopy(new_ob)
+        ob = np.array(new_ob, copy=True)
+        if collect_rgb:
+            render_into(cur_ep_len)
 
         if done:
-            obs = np.array(obs)
-            acs = np.array(acs)
-            env_rews = np.array(env_rews)
             out = {
-                "obs": obs,
-                "acs": acs,
-                "env_rews": env_rews,
+                "obs": obs[:cur_ep_len],
+                "acs": acs[:cur_ep_len],
+                "env_rews": env_rews[:cur_ep_len],
                 "ep_len": cur_ep_len,
                 "ep_env_ret": cur_ep_env_ret,
             }
+            if collect_rgb:
+                assert obs_rgb is not None
+                out["obs_rgb"] = obs_rgb[:cur_ep_len + 1]
             yield out
 
             cur_ep_len = 0
             cur_ep_env_ret = 0
-            obs = []
-            acs = []
-            env_rews = []
             logger.warn("remember: in episode generator, we generate a seed randomly")
             logger.warn("i.e. not using 'ob, _ = env.reset(seed=seed)' with same seed")
             ob, _ = env.reset(seed=seed + rng.integers(100000, size=1).item())
+            if collect_rgb:
+                render_into(0)
 
 
 @beartype
@@ -292,7 +370,7 @@ def evaluate(cfg: DictConfig,
     agent = agent_wrapper()
 
     # create episode generator
-    ep_gen = episode(env, agent, cfg.seed)
+    ep_gen = episode(env, agent, cfg.seed, collect_rgb=cfg.record)
 
     # load the model
     model_path = cfg.model_path
@@ -316,8 +394,7 @@ def evaluate(cfg: DictConfig,
 
         if cfg.record:
             # record a video of the episode
-            frame_collection = env.render()  # ref: https://younis.dev/blog/render-api/
-            record_video(vid_dir, str(i), np.array(frame_collection))
+            record_video(vid_dir, str(i), traj["obs_rgb"])
 
     eval_metrics = {"ep_len": len_buff, "ep_env_ret": env_ret_buff}
 
@@ -393,10 +470,13 @@ def learn(cfg: DictConfig,
     roll_gen = segment(env, agent, cfg.seed, cfg.segment_len, wrap_absorb=cfg.wrap_absorb)
     # create episode generator for evaluating the agent
     eval_seed = cfg.seed + 123456  # arbitrary choice
-    ep_gen = episode(eval_env, agent, eval_seed)
+    ep_gen = episode(eval_env, agent, eval_seed, collect_rgb=cfg.record)
 
     i = 0
 
+    # per-iteration timings
+    stats = RunningStats()
+
     while agent.timesteps_so_far <= cfg.num_timesteps:
 
         logger.info((f"iter#{i}").upper())
@@ -413,48 +493,50 @@ def learn(cfg: DictConfig,
         logger.info(("train").upper())
 
         tts = time.time()
-        ttl = []
-        gtl = []
-        dtl = []
+        stats.clear()
         gs, ds = 0, 0
         for _ in range(tot := cfg.training_steps_per_iter):
 
+            # sample the batches of transitions for all the g-steps and d-steps at once
+            # note: the patched rewards of the d-step batches are not used by the discriminator
+            batches = agent.sample_batches((gs := cfg.g_steps) + (ds := cfg.d_steps))
+
             gts = time.time()
-            for _ in range(gs := cfg.g_steps):
-                # sample a batch of transitions from the replay buffer
-                batch = agent.sample_batch()
+            for j in range(gs):
+                batch = batches[j]
                 # determine if updating the actr
                 update_actr = not bool(agent.crit_updates_so_far % cfg.actor_update_delay)
                 with ctx("actor-critic training"):
                     # update the actor and critic
                     agent.update_actr_crit(batch=batch, update_actr=update_actr)
-                gtl.append(time.time() - gts)
+                stats.add("gt", time.time() - gts)
                 gts = time.time()
 
             dts = time.time()
-            for _ in range(ds := cfg.d_steps):
-                # sample a batch of transitions from the replay buffer
-                batch = agent.sample_batch()
+            for j in range(ds):
+                batch = batches[gs + j]
                 with ctx("discriminator training"):
                     # update the discriminator
                     agent.update_disc(batch)
-                dtl.append(time.time() - dts)
+                stats.add("dt", time.time() - dts)
                 dts = time.time()
 
-            ttl.append(time.time() - tts)
+            stats.add("tt", time.time() - tts)
             tts = time.time()
 
+        avg_tt_per_iter = stats.mean("tt")  # logged in eval
         logger.info(colored(
-            f"avg tt over {tot}steps: {(avg_tt_per_iter := np.mean(ttl))}secs",  # logged in eval
+            f"avg tt over {tot}steps: {avg_tt_per_iter}secs",
             "green", attrs=["reverse"]))
+        avg_gt, avg_dt, tot_tt = stats.mean("gt"), stats.mean("dt"), stats.sum("tt")
         logger.info(colored(
-            f"avg gt over {tot}steps X {gs} g-steps: {np.mean(gtl)}secs",
+            f"avg gt over {tot}steps X {gs} g-steps: {avg_gt}secs",
             "green"))
         logger.info(colored(
-            f"avg dt over {tot}steps X {ds} d-steps: {np.mean(dtl)}secs",
+            f"avg dt over {tot}steps X {ds} d-steps: {avg_dt}secs",
             "green"))
         logger.info(colored(
-            f"tot tt over {tot}steps: {np.sum(ttl)}secs",
+            f"tot tt over {tot}steps: {tot_tt}secs",
             "magenta", attrs=["reverse"]))
 
         i += 1
@@ -476,9 +558,7 @@ def learn(cfg: DictConfig,
 
                 if cfg.record:
                     # record a video of the episode
-                    # ref: https://younis.dev/blog/render-api/
-                    frame_collection = eval_env.render()
-                    record_video(vid_dir, f"iter{i}-ep{j}", np.array(frame_collection))
+                    record_video(vid_dir, f"iter{i}-ep{j}", ep["obs_rgb"])
 
             eval_metrics: dict[str, np.ndarray] = {
                 "ep_len": np.array(len_buff), "ep_env_ret": np.array(env_ret_buff)}
@@ -496,7 +576,7 @@ def learn(cfg: DictConfig,
                 {**{f"{k}-mean": v.mean() for k, v in eval_metrics.items()},
                  "rbx-num-entries": np.array(agent.replay_buffers[0].num_entries),
                  # taking the first because this one will always exist whatever the numenv
-                 "avg-tt-per-iter": avg_tt_per_iter},
+                 "avg-tt-per-iter": np.float64(avg_tt_per_iter)},
                 step_metric=agent.timesteps_so_far,
                 glob="eval",
             )